@@ -262,7 +262,8 @@ class BaseSIREstimation:
             power_t=power_t, min_threshold=min_threshold,
             max_threshold=max_threshold)
 
-        sgd.train(X, y, fct_loss, fct_grad, max_iter=max_iter,
+        sgd.train(numpy.ascontiguousarray(X), numpy.ascontiguousarray(y),
+                  fct_loss, fct_grad, max_iter=max_iter,
                   early_th=early_th, verbose=verbose)
 
         # uses trained coefficients
@@ -0,0 +1,30 @@
+# cython: boundscheck=False, wraparound=False, language_level=3
+"""
+Compiled version of the update step of
+:class:`SGDOptimizer <aftercovid.optim.SGDOptimizer>`.
+"""
+import numpy
+
+
+def sgd_step(double[::1] coef, double[::1] velocity, grad,
+             double momentum, double lr, double weight_decay=0.,
+             bint nesterov=False, buf=None):
+    """
+    Same as :func:`_sgd_step_numpy <aftercovid.optim.sgd._sgd_step_numpy>`
+    for one dimension C-contiguous arrays of float64,
+    *grad* is converted into float64 if needed, *buf* is not needed.
+    """
+    cdef const double[::1] g = numpy.ascontiguousarray(
+        grad, dtype=numpy.float64)
+    cdef Py_ssize_t i, n = coef.shape[0]
+    cdef double step
+    if velocity.shape[0] != n or g.shape[0] != n:
+        raise ValueError("coef, velocity and grad must have the same size.")
+    with nogil:
+        for i in range(n):
+            step = lr * (g[i] + weight_decay * coef[i])
+            velocity[i] = momentum * velocity[i] - step
+            if nesterov:
+                coef[i] += momentum * velocity[i] - step
+            else:
+                coef[i] += velocity[i]
@@ -4,8 +4,124 @@ It is inspired from `_stochastic_optimizers.py
 <https://github.com/scikit-learn/scikit-learn/blob/master/sklearn/
 neural_network/_stochastic_optimizers.py>`_.
 """
+import math
+import warnings
 import numpy
 from numpy.core._exceptions import UFuncTypeError
+try:
+    from numba import njit
+except ImportError:  # pragma: no cover
+    njit = None
+try:
+    from ._sgd_step import sgd_step as _sgd_step_cython
+except ImportError:  # pragma: no cover
+    # the extension is not compiled
+    _sgd_step_cython = None
+
+
+def _sgd_step_numpy(coef, velocity, grad, momentum, lr,
+                    weight_decay=0., nesterov=False, buf=None):
+    """
+    Updates *velocity* and *coef* inplace,
+    `g = grad + weight_decay * coef`,
+    `velocity = momentum * velocity - lr * g`,
+    `coef += velocity` or `coef += momentum * velocity - lr * g`
+    if *nesterov* is True. *buf* is an optional array with the same
+    shape as *coef* used to store `lr * g` and avoid any allocation.
+    """
+    if weight_decay:
+        buf = numpy.multiply(coef, weight_decay, out=buf)
+        buf += grad
+        buf *= lr
+    else:
+        buf = numpy.multiply(grad, lr, out=buf)
+    numpy.multiply(velocity, momentum, out=velocity)
+    velocity -= buf
+    if nesterov:
+        coef -= buf
+        coef += numpy.multiply(velocity, momentum, out=buf)
+    else:
+        coef += velocity
+
+
+if njit is None:
+    _sgd_step = _sgd_step_numpy  # pragma: no cover
+else:
+    @njit(fastmath=True, cache=True)
+    def _sgd_step(coef, velocity, grad, momentum, lr,
+                  weight_decay=0., nesterov=False, buf=None):
+        """
+        Same as :func:`_sgd_step_numpy` but compiled with :epkg:`numba`
+        for one dimension arrays, *buf* is not needed.
+        """
+        for i in range(coef.size):
+            g = lr * (grad[i] + weight_decay * coef[i])
+            velocity[i] = momentum * velocity[i] - g
+            if nesterov:
+                coef[i] += momentum * velocity[i] - g
+            else:
+                coef[i] += velocity[i]
+
+
+def _train_linear_epoch_numpy(Xs, ys, coef, velocity, batch_size,
+                              momentum, lr, weight_decay, nesterov,
+                              lower, upper):
+    """
+    Runs one epoch of :meth:`SGDOptimizer.train_linear
+    <aftercovid.optim.SGDOptimizer.train_linear>`, *Xs*, *ys* are
+    already shuffled, the gradient of every mini-batch is
+    `Xb.T @ (Xb @ coef - yb) / len(yb)`, *lower* and *upper*
+    are None or arrays of bounds for the coefficients.
+    """
+    n = Xs.shape[0]
+    for begin in range(0, n, batch_size):
+        end = min(begin + batch_size, n)
+        Xb = Xs[begin:end]
+        grad = Xb.T @ (Xb @ coef - ys[begin:end]) / (end - begin)
+        _sgd_step(coef, velocity, grad, momentum, lr, weight_decay, nesterov)
+        if lower is not None:
+            numpy.maximum(coef, lower, coef)
+        if upper is not None:
+            numpy.minimum(coef, upper, coef)
+
+
+if njit is None:
+    _train_linear_epoch = _train_linear_epoch_numpy  # pragma: no cover
+else:
+    _train_linear_epoch = njit(fastmath=True, cache=True)(
+        _train_linear_epoch_numpy)
+
+
+def _linear_loss(coef, X, y):
+    "Loss of a linear regression, `||X @ coef - y||^2`."
+    return numpy.linalg.norm(X @ coef - y) ** 2
+
+
+def _linear_grad(coef, X, y, i=None):
+    """
+    Gradient used by :meth:`SGDOptimizer.train_linear
+    <aftercovid.optim.SGDOptimizer.train_linear>`,
+    `X.T @ (X @ coef - y) / len(y)`, *X* is a row or a mini-batch.
+    """
+    X = numpy.atleast_2d(X)
+    return X.T @ (X @ coef - y) / X.shape[0]
+
+
+def _contiguous_float(name, value):
+    """
+    Returns *value* as a C-contiguous array of floats,
+    integers are converted into float64. A warning is raised
+    if a copy is needed.
+    """
+    is_float = numpy.issubdtype(value.dtype, numpy.floating)
+    if is_float and value.flags['C_CONTIGUOUS']:
+        return value
+    warnings.warn(
+        "{} is copied into a C-contiguous array of floats (dtype={}, "
+        "C_CONTIGUOUS={}).".format(
+            name, value.dtype, value.flags['C_CONTIGUOUS']))
+    return numpy.ascontiguousarray(
+        value, dtype=value.dtype if is_float else numpy.float64)
 
 
 class BaseOptimizer:
@@ -18,6 +134,12 @@ class BaseOptimizer:
         in updating the weights.
     :param min_threshold: coefficients must be higher than *min_thresold*
     :param max_threshold: coefficients must be below than *max_thresold*
+    :param seed: seed for the random generator which shuffles the rows
+        used to compute the gradient (see :func:`numpy.random.default_rng`)
+    :param dtype: if not None, the coefficients are copied and stored
+        with this type, `numpy.float32` halves the memory used by
+        the coefficients and the velocity, the gradient is cast
+        into this type, any floating type is supported
 
     The class holds the following attributes:
 
@@ -25,14 +147,18 @@ class BaseOptimizer:
     """
 
     def __init__(self, coef, learning_rate_init=0.1,
-                 min_threshold=None, max_threshold=None):
+                 min_threshold=None, max_threshold=None, seed=None,
+                 dtype=None):
         if not isinstance(coef, numpy.ndarray):
             raise TypeError("coef must be an array.")
-        self.coef = coef
+        if dtype is not None:
+            coef = coef.astype(dtype, copy=True)
+        self.coef = _contiguous_float('coef', coef)
         self.learning_rate_init = learning_rate_init
         self.learning_rate = float(learning_rate_init)
         self.min_threshold = min_threshold
         self.max_threshold = max_threshold
+        self._rng = numpy.random.default_rng(seed)
 
     def _get_updates(self, grad):
         raise NotImplementedError("Must be overwritten.")  # pragma no cover
@@ -45,18 +171,28 @@ class BaseOptimizer:
         """
         if self.coef.shape != grad.shape:
             raise ValueError("coef and grad must have the same shape.")
+        self._update_coef(grad)
+
+    def _update_coef(self, grad):
+        """
+        Same as :meth:`update_coef` without checking the gradient shape.
+        """
         update = self._get_updates(grad)
         self.coef += update
+        self._clip_coef()
+
+    def _clip_coef(self):
+        "Applies thresholds *min_threshold*, *max_threshold* inplace."
         if self.min_threshold is not None:
             try:
-                self.coef = numpy.maximum(self.coef, self.min_threshold)
+                numpy.maximum(self.coef, self.min_threshold, out=self.coef)
             except UFuncTypeError:  # pragma: no cover
                 raise RuntimeError(
                     "Unable to compute an upper bound with coef={} "
                     "max_threshold={}".format(self.coef, self.min_threshold))
         if self.max_threshold is not None:
             try:
-                self.coef = numpy.minimum(self.coef, self.max_threshold)
+                numpy.minimum(self.coef, self.max_threshold, out=self.coef)
             except UFuncTypeError:  # pragma: no cover
                 raise RuntimeError(
                     "Unable to compute a lower bound with coef={} "
@@ -70,7 +206,7 @@ class BaseOptimizer:
         pass  # pragma: no cover
 
     def train(self, X, y, fct_loss, fct_grad, max_iter=100,
-              early_th=None, verbose=False):
+              early_th=None, verbose=False, batch_size=1):
         """
         Optimizes the coefficients.
 
@@ -83,46 +219,118 @@ class BaseOptimizer:
         :param early_th: stops the training if the error goes below
             this threshold
         :param verbose: display information
+        :param batch_size: number of rows used to compute every gradient,
+            rows are shuffled at every epoch so that every row
+            is used once per epoch,
+            if *batch_size* is 1, *fct_grad* receives one row *x*,
+            its target *y* and the row index *i*, otherwise it receives
+            a mini-batch *X*, the targets *y*, the row indices *i* and
+            must return the gradient averaged over the mini-batch,
+            *x*, *y*, *i* are views on buffers overwritten at every
+            epoch, they must be copied to be kept
         :return: loss
+
+        When the gradient can be written with matrix operations,
+        a function computing it for a whole mini-batch
+        (signature `g(coef, X, y, i) -> array`) is much faster
+        than a loop over every row. With `batch_size=X.shape[0]`,
+        every epoch is a single gradient descent step computed
+        with a couple of matrix products. For a linear regression,
+        `X.T @ (X @ coef - y)` remains faster than
+        `numpy.einsum('ij,i->j', X, X @ coef - y)` even for
+        small batches (< 32 rows), and option `optimize=True`
+        makes :func:`numpy.einsum` much slower on such small arrays
+        as the contraction path is searched at every call.
         """
+        X, y = self._check_train(X, y, batch_size)
+        verbose_grad = isinstance(verbose, int) and verbose >= 10
+
+        def run_epoch(it, Xs, ys, irows, loss):
+            # local names avoid attribute lookups in the inner loop,
+            # coef is updated inplace by update_coef, the shape of the
+            # gradient is only checked for the first update
+            coef = self.coef
+            update_coef = self.update_coef if it == 0 else self._update_coef
+            update_coef_fast = self._update_coef
+            isnan = numpy.isnan
+            for begin in range(0, irows.shape[0], batch_size):
+                if batch_size == 1:
+                    grad = fct_grad(coef, Xs[begin], ys[begin], irows[begin])
+                else:
+                    end = begin + batch_size
+                    grad = fct_grad(coef, Xs[begin:end], ys[begin:end],
+                                    irows[begin:end])
+                if verbose_grad:
+                    self._display_progress(  # pragma: no cover
+                        0, max_iter, loss, grad, 'grad')
+                if isnan(grad).any():
+                    raise RuntimeError(  # pragma: no cover
+                        "The gradient has nan values.")
+                update_coef(grad)
+                update_coef = update_coef_fast
+
+        return self._train_epochs(X, y, fct_loss, run_epoch, max_iter,
+                                  early_th, verbose)
+
+    def _check_train(self, X, y, batch_size):
+        "Checks the training data, returns contiguous arrays."
         if not isinstance(X, numpy.ndarray):
             raise TypeError("X must be an array.")
         if not isinstance(y, numpy.ndarray):
             raise TypeError("y must be an array.")
         if X.shape[0] != y.shape[0]:
             raise ValueError("X and y must have the same number of rows.")
+        X = _contiguous_float('X', X)
+        y = _contiguous_float('y', y)
         if any(numpy.isnan(X.ravel())):
             raise ValueError("X contains nan value.")
         if any(numpy.isnan(y.ravel())):
             raise ValueError("y contains nan value.")
+        if batch_size < 1:
+            raise ValueError(
+                "batch_size must be >= 1 not {}.".format(batch_size))
+        return X, y
 
-        loss = fct_loss(self.coef, X, y)
+    def _train_epochs(self, X, y, fct_loss, run_epoch, max_iter,
+                      early_th, verbose):
+        """
+        Runs the training epochs, shuffles the rows, calls
+        `run_epoch(it, Xs, ys, irows, loss)` to update the coefficients,
+        updates the learning rate and evaluates the loss if needed.
+        """
+        # the loss is only needed every epoch to display it
+        # or to stop early, otherwise it is computed once at the end
+        epoch_loss = verbose or early_th is not None
+        loss = fct_loss(self.coef, X, y) if epoch_loss else None
         losses = [loss]
         if verbose:
             self._display_progress(0, max_iter, loss)
         n_samples = 0
+        # shuffled copies of X and y, allocated once and filled
+        # at every epoch, every row or batch is a view on them
+        Xs = numpy.empty_like(X)
+        ys = numpy.empty_like(y)
+        irows = numpy.arange(X.shape[0])
         for it in range(max_iter):
-            irows = numpy.random.choice(X.shape[0], X.shape[0])
-            for irow in irows:
-                grad = fct_grad(self.coef, X[irow, :], y[irow], irow)
-                if isinstance(verbose, int) and verbose >= 10:
-                    self._display_progress(  # pragma: no cover
-                        0, max_iter, loss, grad, 'grad')
-                if numpy.isnan(grad).sum() > 0:
-                    raise RuntimeError(  # pragma: no cover
-                        "The gradient has nan values.")
-                self.update_coef(grad)
-                n_samples += 1
+            self._rng.shuffle(irows)
+            numpy.take(X, irows, axis=0, out=Xs)
+            numpy.take(y, irows, axis=0, out=ys)
+            run_epoch(it, Xs, ys, irows, loss)
 
+            n_samples += X.shape[0]
             self.iteration_ends(n_samples)
+            self.iter_ = it + 1
+            if not epoch_loss:
+                continue
             loss = fct_loss(self.coef, X, y)
             if verbose:
                 self._display_progress(it + 1, max_iter, loss)
-            self.iter_ = it + 1
             losses.append(loss)
             if self._evaluate_early_stopping(
                     it, max_iter, losses, early_th, verbose=verbose):
                 break
+        if not epoch_loss:
+            loss = fct_loss(self.coef, X, y)
         return loss
 
     def _evaluate_early_stopping(
@@ -185,11 +393,28 @@ class SGDOptimizer(BaseOptimizer):
         is on, the current learning rate is divided by 5.
     :param momentum: float
         Value of momentum used, must be larger than or equal to 0
+    :param nesterov: uses Nesterov's momentum
+    :param weight_decay: float, L2 penalty, the gradient becomes
+        `grad + weight_decay * coef`
     :param power_t: double
         The exponent for inverse scaling learning rate.
     :param early_th: stops if the error goes below that threshold
     :param min_threshold: lower bound for parameters (can be None)
     :param max_threshold: upper bound for parameters (can be None)
+    :param seed: seed for the random generator which shuffles the rows
+        used to compute the gradient
+    :param dtype: type of the coefficients, the coefficients keep the type
+        of *coef* if None, any floating type is supported,
+        the update is compiled for `numpy.float32` and `numpy.float64`,
+        other types such as `numpy.float16` or `numpy.longdouble`
+        use a slower :epkg:`numpy` implementation
+    :param device: `'cpu'` or `'cuda'`, with `'cuda'`, coefficients,
+        velocity and the update buffer are allocated on GPU with
+        :epkg:`cupy` (and reused through its memory pool),
+        the gradient function receives the coefficients as a
+        :epkg:`cupy` array and must return one, this is only worth it
+        for large vectors of coefficients (more than 1e5 elements)
+        when the gradient is computed on GPU as well
 
     The class holds the following attributes:
 
@@ -223,19 +448,140 @@ class SGDOptimizer(BaseOptimizer):
             sgd = SGDOptimizer(numpy.random.randn(3))
             sgd.train(X, y, fct_loss, fct_grad, max_iter=15, verbose=True)
             print('optimized coefficients:', sgd.coef)
+
+        The same optimisation with mini-batches of 5 rows.
+
+        .. runpython::
+            :showcode:
+
+            import numpy
+            from aftercovid.optim import SGDOptimizer
+
+
+            def fct_loss(c, X, y):
+                return numpy.linalg.norm(X @ c - y) ** 2
+
+
+            def fct_grad_batch(c, X, y, i=None):
+                r = X @ c - y
+                return (X.T @ r) * (0.1 / len(y))
+
+
+            coef = numpy.array([0.5, 0.6, -0.7])
+            X = numpy.random.randn(10, 3)
+            y = X @ coef
+
+            sgd = SGDOptimizer(numpy.random.randn(3))
+            sgd.train(X, y, fct_loss, fct_grad_batch, max_iter=30,
+                      batch_size=5, verbose=True)
+            print('optimized coefficients:', sgd.coef)
+
+            # every epoch computes the gradient over the whole dataset
+            sgd = SGDOptimizer(numpy.random.randn(3), learning_rate_init=1.)
+            sgd.train(X, y, fct_loss, fct_grad_batch, max_iter=100,
+                      batch_size=X.shape[0])
+            print('optimized coefficients:', sgd.coef)
     """
 
     def __init__(self, coef, learning_rate_init=0.1, lr_schedule='constant',
                  momentum=0.9, power_t=0.5, early_th=None,
-                 min_threshold=None, max_threshold=None):
+                 min_threshold=None, max_threshold=None, seed=None,
+                 nesterov=False, weight_decay=0., dtype=None,
+                 device='cpu'):
         super().__init__(coef, learning_rate_init,
                          min_threshold=min_threshold,
-                         max_threshold=max_threshold)
+                         max_threshold=max_threshold, seed=seed,
+                         dtype=dtype)
+        if device == 'cpu':
+            xp = numpy
+            if self.coef.ndim != 1:
+                self._step = _sgd_step_numpy
+            elif (_sgd_step_cython is not None and
+                    self.coef.dtype == numpy.float64):
+                self._step = _sgd_step_cython
+            elif self.coef.dtype in (numpy.float32, numpy.float64):
+                self._step = _sgd_step
+            else:
+                # numba does not support float16 or longdouble
+                self._step = _sgd_step_numpy
+        elif device == 'cuda':
+            import cupy as xp
+            self.coef = xp.asarray(self.coef)
+            self._step = _sgd_step_numpy
+        else:
+            raise ValueError(
+                "device must be 'cpu' or 'cuda' not {!r}.".format(device))
+        self.device = device
         self.lr_schedule = lr_schedule
         self.momentum = momentum
+        self.nesterov = nesterov
+        self.weight_decay = weight_decay
         self.power_t = power_t
         self.early_th = early_th
-        self.velocity = numpy.zeros_like(coef)
+        self.velocity = xp.zeros_like(self.coef)
+        self._update_buf = xp.empty_like(self.velocity)
+
+    def train_linear(self, X, y, max_iter=100, early_th=None,
+                     verbose=False, batch_size=1):
+        """
+        Optimizes the coefficients of a linear regression
+        `X @ coef = y` for the loss `||X @ coef - y||^2`.
+        It is equivalent to method :meth:`train
+        <aftercovid.optim.sgd.BaseOptimizer.train>` with a gradient
+        computed over every mini-batch with
+        `X.T @ (X @ coef - y) / len(y)` but every epoch runs
+        in a single function compiled with :epkg:`numba`
+        if it is available and if the coefficients are float32
+        or float64, other floating types go through method
+        :meth:`train <aftercovid.optim.sgd.BaseOptimizer.train>`.
+
+        :param X: datasets (array)
+        :param y: expected target (vector)
+        :param max_iter: number maximum of iteration
+        :param early_th: stops the training if the error goes below
+            this threshold
+        :param verbose: display information
+        :param batch_size: number of rows used to compute every gradient
+        :return: loss
+        """
+        if self.device != 'cpu' or self.coef.ndim != 1:
+            raise ValueError(
+                "train_linear only works with a vector of coefficients "
+                "on cpu.")
+        X, y = self._check_train(X, y, batch_size)
+        if len(X.shape) != 2 or X.shape[1] != self.coef.shape[0]:
+            raise ValueError(
+                "X must be a matrix with {} columns.".format(
+                    self.coef.shape[0]))
+        if len(y.shape) != 1:
+            raise ValueError("y must be a vector.")
+        dtype = self.coef.dtype
+        X = X.astype(dtype, copy=False)
+        y = y.astype(dtype, copy=False)
+        if dtype not in (numpy.float32, numpy.float64):
+            # numba does not support float16 or longdouble
+            return self.train(X, y, _linear_loss, _linear_grad,
+                              max_iter=max_iter, early_th=early_th,
+                              verbose=verbose, batch_size=batch_size)
+
+        def bound(threshold):
+            if threshold is None:
+                return None
+            res = numpy.empty_like(self.coef)
+            res[:] = threshold
+            return res
+
+        lower = bound(self.min_threshold)
+        upper = bound(self.max_threshold)
+
+        def run_epoch(it, Xs, ys, irows, loss):
+            _train_linear_epoch(
+                Xs, ys, self.coef, self.velocity, batch_size,
+                self.momentum, self.learning_rate, self.weight_decay,
+                self.nesterov, lower, upper)
+
+        return self._train_epochs(X, y, _linear_loss, run_epoch, max_iter,
+                                  early_th, verbose)
 
     def iteration_ends(self, time_step):
         """
@@ -247,19 +593,26 @@ class SGDOptimizer(BaseOptimizer):
             learning rate for 'invscaling'
         """
         if self.lr_schedule == 'invscaling':
-            self.learning_rate = (float(self.learning_rate_init) /
-                                  (time_step + 1) ** self.power_t)
-
-    def _get_updates(self, grad):
+            if self.power_t == 0.5:
+                self.learning_rate = (float(self.learning_rate_init) /
+                                      math.sqrt(time_step + 1))
+            else:
+                self.learning_rate = (float(self.learning_rate_init) /
+                                      (time_step + 1) ** self.power_t)
+
+    def _update_coef(self, grad):
         """
-        Gets the values used to update params with given gradients.
+        Updates coefficients with given gradient without checking its shape.
+        Velocity and coefficients are updated inplace in a single step
+        (compiled with :epkg:`cython` for float64 coefficients
+        or :epkg:`numba` if available).
 
         :param grad: array, gradient
-        :return: updates, array, the values to add to params
         """
-        update = self.momentum * self.velocity - self.learning_rate * grad
-        self.velocity = update
-        return update
+        self._step(self.coef, self.velocity, grad,
+                   self.momentum, self.learning_rate,
+                   self.weight_decay, self.nesterov, self._update_buf)
+        self._clip_coef()
 
     def _display_progress(self, it, max_iter, loss, losses=None, msg='loss'):
         'Displays training progress.'
@@ -120,11 +120,13 @@ epkg_dictionary = {
     'COVID': 'https://en.wikipedia.org/wiki/Coronavirus_disease_2019',
     'covidtracker': 'https://covidtracker.fr/covidtracker-france/',
     'CSSE Johns Hopkins': 'https://github.com/CSSEGISandData/COVID-19',
+    'cupy': 'https://cupy.dev/',
     'cython': 'https://cython.org/',
     'DOT': 'https://www.graphviz.org/doc/info/lang.html',
     'epyestim': 'https://github.com/lo-hfk/epyestim',
     'INSEE': 'https://www.insee.fr/fr/accueil',
     'pyepydemic': 'https://pyepydemic.readthedocs.io/en/latest/index.html',
+    'numba': 'https://numba.pydata.org/',
     'numpy': 'https://numpy.org/',
     'pyinstrument': 'https://github.com/joerick/pyinstrument',
     'python': 'https://www.python.org/',
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
-from setuptools import setup
+from setuptools import setup, Extension
 from setuptools import find_packages
 
 ######################
@@ -45,7 +45,18 @@ with open(os.path.join(here, 'requirements.txt'), "r") as f:
     requires = [_.strip() for _ in f.readlines()]
     requires = [_ for _ in requires if _]
 
-ext_modules = []
+try:
+    from Cython.Build import cythonize
+except ImportError:  # pragma: no cover
+    cythonize = None
+
+if cythonize is None:
+    ext_modules = []
+else:
+    ext_modules = cythonize([
+        Extension("aftercovid.optim._sgd_step",
+                  [os.path.join(here, "aftercovid", "optim",
+                                "_sgd_step.pyx")])])
 
 
 setup(name='aftercovid',
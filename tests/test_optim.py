@@ -6,6 +6,13 @@ from contextlib import redirect_stdout
 import unittest
 import numpy
 from aftercovid.optim import SGDOptimizer
+from aftercovid.optim.sgd import (
+    _sgd_step, _sgd_step_numpy, _sgd_step_cython,
+    _train_linear_epoch, _train_linear_epoch_numpy)
+try:
+    import cupy
+except ImportError:
+    cupy = None
 
 
 def fct_loss(c, X, y):
@@ -16,6 +23,10 @@ def fct_grad(c, x, y, i):
     return x * (x @ c - y) * 0.1
 
 
+def fct_grad_batch(c, X, y, i):
+    return X.T @ (X @ c - y) * 0.1 / len(y)
+
+
 class TestOptim(unittest.TestCase):
 
     def test_sgd_optimizer(self):
@@ -54,6 +65,280 @@ class TestOptim(unittest.TestCase):
         self.assertLess(ls, 1)
         self.assertLess(sgd.learning_rate, 0.1)
 
+    def test_sgd_optimizer_batch(self):
+        coef = numpy.array([0.5, 0.6, 0.7])
+
+        X = numpy.random.randn(100, 3)
+        y = X @ coef
+
+        gr = fct_grad_batch(coef, X[:10], y[:10], None)
+        no = numpy.linalg.norm(gr)
+        self.assertLess(no, 1e-10)
+
+        sgd = SGDOptimizer(numpy.array([0., 0., 0.]))
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            ls = sgd.train(X, y, fct_loss, fct_grad_batch, max_iter=30,
+                           batch_size=16, verbose=True)
+        out = buf.getvalue()
+        self.assertIn("30/30: loss", out)
+        self.assertLess(ls, 0.1)
+
+        sgd = SGDOptimizer(numpy.array([0., 0., 0.]), learning_rate_init=1.)
+        ls = sgd.train(X, y, fct_loss, fct_grad_batch, max_iter=100,
+                       batch_size=X.shape[0])
+        self.assertLess(ls, 0.1)
+
+        with self.assertRaises(ValueError):
+            sgd.train(X, y, fct_loss, fct_grad_batch, batch_size=0)
+
+    def test_sgd_optimizer_loss_calls(self):
+        coef = numpy.array([0.5, 0.6, 0.7])
+        X = numpy.random.randn(10, 3)
+        y = X @ coef
+        calls = []
+
+        def fct_loss_count(c, X, y):
+            calls.append(1)
+            return fct_loss(c, X, y)
+
+        sgd = SGDOptimizer(numpy.array([0., 0., 0.]))
+        ls = sgd.train(X, y, fct_loss_count, fct_grad, max_iter=15)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sgd.iter_, 15)
+        self.assertEqual(ls, fct_loss(sgd.coef, X, y))
+
+        del calls[:]
+        sgd = SGDOptimizer(numpy.array([0., 0., 0.]))
+        with redirect_stdout(io.StringIO()):
+            sgd.train(X, y, fct_loss_count, fct_grad, max_iter=15,
+                      verbose=True)
+        self.assertEqual(len(calls), 16)
+
+    def test_sgd_optimizer_contiguous(self):
+        coef = numpy.array([0.5, 0.6, 0.7])
+        X = numpy.random.randn(3, 10).T
+        y = X @ coef
+
+        with self.assertWarns(UserWarning):
+            sgd = SGDOptimizer(numpy.array([0, 0, 0]))
+        self.assertEqual(sgd.coef.dtype, numpy.float64)
+        self.assertEqual(sgd.velocity.dtype, numpy.float64)
+        with self.assertWarns(UserWarning):
+            ls = sgd.train(X, y, fct_loss, fct_grad, max_iter=15)
+        self.assertLess(ls, 0.1)
+
+    def test_sgd_optimizer_float32(self):
+        coef = numpy.array([0.5, 0.6, 0.7])
+        X = numpy.random.randn(10, 3)
+        y = X @ coef
+
+        init = numpy.array([0., 0., 0.])
+        sgd = SGDOptimizer(init, dtype=numpy.float32)
+        self.assertEqual(sgd.coef.dtype, numpy.float32)
+        self.assertEqual(sgd.velocity.dtype, numpy.float32)
+        ls = sgd.train(X, y, fct_loss, fct_grad, max_iter=30)
+        self.assertLess(ls, 0.1)
+        self.assertEqual(sgd.coef.dtype, numpy.float32)
+        self.assertEqual(init.tolist(), [0., 0., 0.])
+
+        sgd = SGDOptimizer(init, dtype=numpy.float16)
+        self.assertEqual(sgd.velocity.dtype, numpy.float16)
+        ls = sgd.train(X, y, fct_loss, fct_grad, max_iter=30)
+        self.assertLess(ls, 0.1)
+        self.assertEqual(sgd.coef.dtype, numpy.float16)
+
+        sgd = SGDOptimizer(numpy.array([[0., 0.], [0., 0.]]),
+                           dtype=numpy.float32)
+        sgd.update_coef(numpy.array([[1., 2.], [3., 4.]]))
+        self.assertEqual(sgd.coef.dtype, numpy.float32)
+        numpy.testing.assert_allclose(
+            sgd.coef, [[-0.1, -0.2], [-0.3, -0.4]], rtol=1e-6)
+
+    def test_sgd_optimizer_float16(self):
+        coef = numpy.array([0.5, 0.6, 0.7])
+        X = numpy.random.randn(10, 3)
+        y = X @ coef
+
+        for dtype in [numpy.float16, numpy.longdouble]:
+            with self.subTest(dtype=dtype):
+                sgd = SGDOptimizer(numpy.zeros(3, dtype=dtype))
+                self.assertIs(sgd._step, _sgd_step_numpy)
+                ls = sgd.train(X, y, fct_loss, fct_grad, max_iter=30)
+                self.assertLess(ls, 0.1)
+                self.assertEqual(sgd.coef.dtype, dtype)
+
+    @unittest.skipIf(cupy is None, reason="cupy is not installed")
+    def test_sgd_optimizer_cuda(self):
+        coef = numpy.array([0.5, 0.6, 0.7])
+        X = numpy.random.randn(10, 3)
+        y = X @ coef
+
+        def fct_grad_cuda(c, x, y, i):
+            return cupy.asarray(x) * (float(x @ c.get() - y) * 0.1)
+
+        sgd = SGDOptimizer(numpy.array([0., 0., 0.]), device='cuda')
+        self.assertIsInstance(sgd.velocity, cupy.ndarray)
+        ls = sgd.train(X, y, lambda c, X, y: fct_loss(c.get(), X, y),
+                       fct_grad_cuda, max_iter=15)
+        self.assertLess(ls, 0.1)
+
+    def test_sgd_optimizer_seed(self):
+        coef = numpy.array([0.5, 0.6, 0.7])
+        X = numpy.random.randn(10, 3)
+        y = X @ coef
+
+        coefs = []
+        for seed in [0, 0, 1]:
+            sgd = SGDOptimizer(numpy.array([0., 0., 0.]), seed=seed)
+            sgd.train(X, y, fct_loss, fct_grad, max_iter=3)
+            coefs.append(sgd.coef)
+        self.assertEqual(coefs[0].tolist(), coefs[1].tolist())
+        self.assertNotEqual(coefs[0].tolist(), coefs[2].tolist())
+
+    def test_sgd_invscaling(self):
+        for power_t in [0.5, 0.25]:
+            sgd = SGDOptimizer(numpy.array([0., 0., 0.]), power_t=power_t,
+                               lr_schedule='invscaling')
+            sgd.iteration_ends(15)
+            self.assertAlmostEqual(sgd.learning_rate, 0.1 / 16 ** power_t)
+
+    def test_sgd_optimizer_permutation(self):
+        coef = numpy.array([0.5, 0.6, 0.7])
+        X = numpy.random.randn(10, 3)
+        y = X @ coef
+        seen = []
+
+        def fct_grad_seen(c, x, y, i):
+            seen.append(i)
+            return fct_grad(c, x, y, i)
+
+        sgd = SGDOptimizer(numpy.array([0., 0., 0.]))
+        sgd.train(X, y, fct_loss, fct_grad_seen, max_iter=1)
+        self.assertEqual(list(sorted(seen)), list(range(10)))
+
+    def test_sgd_step(self):
+        coef = numpy.array([0.5, 0.6, 0.7])
+        vel = numpy.array([0.1, -0.1, 0.2])
+        grad = numpy.array([1., 2., -3.])
+        coef2, vel2 = coef.copy(), vel.copy()
+        _sgd_step(coef, vel, grad, 0.9, 0.1)
+        _sgd_step_numpy(coef2, vel2, grad, 0.9, 0.1,
+                        buf=numpy.empty_like(coef))
+        numpy.testing.assert_allclose(vel, vel2)
+        numpy.testing.assert_allclose(coef, coef2)
+        numpy.testing.assert_allclose(vel, [-0.01, -0.29, 0.48])
+
+    def test_sgd_step_nesterov(self):
+        grad = numpy.array([1., 2., -3.])
+        for nesterov in [False, True]:
+            for weight_decay in [0., 0.01]:
+                with self.subTest(nesterov=nesterov,
+                                  weight_decay=weight_decay):
+                    coef = numpy.array([0.5, 0.6, 0.7])
+                    vel = numpy.array([0.1, -0.1, 0.2])
+                    coef2, vel2 = coef.copy(), vel.copy()
+                    g = grad + weight_decay * coef
+                    exp_vel = vel * 0.9 - g * 0.1
+                    exp_coef = coef + (
+                        exp_vel * 0.9 - g * 0.1 if nesterov else exp_vel)
+                    _sgd_step(coef, vel, grad, 0.9, 0.1,
+                              weight_decay, nesterov)
+                    _sgd_step_numpy(coef2, vel2, grad, 0.9, 0.1,
+                                    weight_decay, nesterov)
+                    numpy.testing.assert_allclose(vel, exp_vel)
+                    numpy.testing.assert_allclose(vel2, exp_vel)
+                    numpy.testing.assert_allclose(coef, exp_coef)
+                    numpy.testing.assert_allclose(coef2, exp_coef)
+
+    def test_sgd_optimizer_nesterov(self):
+        coef = numpy.array([0.5, 0.6, 0.7])
+        X = numpy.random.randn(10, 3)
+        y = X @ coef
+
+        sgd = SGDOptimizer(numpy.array([0., 0., 0.]), nesterov=True,
+                           weight_decay=1e-5)
+        ls = sgd.train(X, y, fct_loss, fct_grad, max_iter=15)
+        self.assertLess(ls, 0.1)
+
+    @unittest.skipIf(_sgd_step_cython is None,
+                     reason="extension is not compiled")
+    def test_sgd_step_cython(self):
+        grad = numpy.array([1., 2., -3.], dtype=numpy.float32)
+        for nesterov in [False, True]:
+            for weight_decay in [0., 0.01]:
+                with self.subTest(nesterov=nesterov,
+                                  weight_decay=weight_decay):
+                    coef = numpy.array([0.5, 0.6, 0.7])
+                    vel = numpy.array([0.1, -0.1, 0.2])
+                    coef2, vel2 = coef.copy(), vel.copy()
+                    _sgd_step_cython(coef, vel, grad, 0.9, 0.1,
+                                     weight_decay, nesterov)
+                    _sgd_step_numpy(coef2, vel2, grad, 0.9, 0.1,
+                                    weight_decay, nesterov)
+                    numpy.testing.assert_allclose(vel, vel2, rtol=1e-6)
+                    numpy.testing.assert_allclose(coef, coef2, rtol=1e-6)
+        with self.assertRaises(ValueError):
+            _sgd_step_cython(coef, vel, grad[:2], 0.9, 0.1)
+        sgd = SGDOptimizer(numpy.array([0., 0., 0.]))
+        self.assertIs(sgd._step, _sgd_step_cython)
+
+    def test_sgd_optimizer_train_linear(self):
+        coef = numpy.array([0.5, 0.6, 0.7])
+        X = numpy.random.randn(100, 3)
+        y = X @ coef
+
+        def fct_grad_mean(c, X, y, i):
+            X = numpy.atleast_2d(X)
+            return X.T @ (X @ c - y) / X.shape[0]
+
+        for batch_size in [1, 16]:
+            for nesterov in [False, True]:
+                with self.subTest(batch_size=batch_size, nesterov=nesterov):
+                    sgd = SGDOptimizer(numpy.array([0., 0., 0.]), seed=0,
+                                       nesterov=nesterov,
+                                       learning_rate_init=0.01)
+                    ls = sgd.train_linear(X, y, max_iter=30,
+                                          batch_size=batch_size)
+                    sgd2 = SGDOptimizer(numpy.array([0., 0., 0.]), seed=0,
+                                        nesterov=nesterov,
+                                        learning_rate_init=0.01)
+                    ls2 = sgd2.train(X, y, fct_loss, fct_grad_mean,
+                                     max_iter=30, batch_size=batch_size)
+                    numpy.testing.assert_allclose(sgd.coef, sgd2.coef)
+                    numpy.testing.assert_allclose(ls, ls2, atol=1e-10)
+                    self.assertLess(ls, 0.1)
+
+        coefs = [numpy.zeros(3), numpy.zeros(3)]
+        vels = [numpy.zeros(3), numpy.zeros(3)]
+        for fct, c, v in zip([_train_linear_epoch, _train_linear_epoch_numpy],
+                             coefs, vels):
+            fct(X, y, c, v, 8, 0.9, 0.1, 0., False, None, numpy.ones(3))
+        numpy.testing.assert_allclose(coefs[0], coefs[1])
+
+        sgd = SGDOptimizer(numpy.array([0., 0., 0.]), min_threshold=0.,
+                           max_threshold=0.55)
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            sgd.train_linear(X, y, max_iter=15, verbose=True)
+        self.assertIn("15/15: loss", buf.getvalue())
+        self.assertLessEqual(sgd.coef.max(), 0.55)
+
+        for dtype in [numpy.float16, numpy.longdouble]:
+            with self.subTest(dtype=dtype):
+                sgd = SGDOptimizer(numpy.zeros(3), dtype=dtype,
+                                   learning_rate_init=0.01)
+                ls = sgd.train_linear(X, y, max_iter=30, batch_size=16)
+                self.assertLess(ls, 0.1)
+                self.assertEqual(sgd.coef.dtype, dtype)
+
+        with self.assertRaises(ValueError):
+            sgd.train_linear(X[:, :2].copy(), y)
+        with self.assertRaises(ValueError):
+            sgd.train_linear(X, X)
+        with self.assertRaises(ValueError):
+            SGDOptimizer(numpy.zeros((3, 2))).train_linear(X, y)
+
     def test_sgd_optimizer_raise(self):
         coef = numpy.array([0.5, 0.6, 0.7])
 
@@ -74,9 +359,13 @@ class TestOptim(unittest.TestCase):
 
         with self.assertRaises(TypeError):
             SGDOptimizer({})
+        with self.assertRaises(ValueError):
+            SGDOptimizer(numpy.array([0., 0., 0.]), device='gpu')
         sgd = SGDOptimizer(numpy.array([0., 0., 0.]))
         with self.assertRaises(ValueError):
             sgd.update_coef(numpy.array([0., 0., 0., 0.]))
+        with self.assertRaises(ValueError):
+            sgd.train(X, y, fct_loss, lambda c, x, y, i: numpy.zeros(4))
         with self.assertRaises(TypeError):
             sgd.train(X, {}, fct_loss, fct_grad)
         with self.assertRaises(TypeError):